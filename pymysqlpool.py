@@ -3,26 +3,29 @@ author: ljk
 email: chaoyuemyself@hotmail.com
 """
 import pymysql
-import warnings
 import logging
 import functools
-import inspect
+import contextlib
+import threading
 import time
+import random
+import weakref
 from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
 __all__ = ['Connection', 'ConnectionPool', 'ConnectionPoolSingleton', 'logger']
 
-warnings.filterwarnings('error', category=pymysql.err.Warning)
-
 # use logging module for easy debug
 
 
 def _init_logger(level='WARNING'):
     logger = logging.getLogger(__name__)
-    handler = logging.StreamHandler()
-    handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)8s: %(message)s', datefmt='%m-%d %H:%M:%S'))
-    logger.addHandler(handler)
-    logger.setLevel(level)
+    if not logger.handlers:
+        # the module may be imported(or reloaded) more than once, don't attach a duplicate handler
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter(fmt='%(asctime)s %(levelname)8s: %(message)s', datefmt='%m-%d %H:%M:%S'))
+        logger.addHandler(handler)
+        logger.setLevel(level)
     return logger
 
 
@@ -37,7 +40,13 @@ class Connection(pymysql.connections.Connection):
         the __exit__() method additionally put the connection back to it's pool
     """
     _pool = None
-    _reusable_expection = (pymysql.err.ProgrammingError, pymysql.err.IntegrityError, pymysql.err.NotSupportedError)
+    _returned = False
+    _use_custom_cursor = False
+    _raise_warnings = False
+    # exception types after which the connection is still reusable, __exit__() receives the exact type
+    _reusable_exceptions = frozenset((pymysql.err.ProgrammingError, pymysql.err.IntegrityError,
+                                      pymysql.err.NotSupportedError))
+    _reusable_expection = _reusable_exceptions  # deprecated misspelled name, kept for backward compatibility
 
     def __init__(self, *args, **kwargs):
         pymysql.connections.Connection.__init__(self, *args, **kwargs)
@@ -53,17 +62,13 @@ class Connection(pymysql.connections.Connection):
         With pool action: put connection back to pool
         """
         if self._pool is not None:
-            if not exc or exc in self._reusable_expection:
+            if not exc or exc in self._reusable_exceptions:
                 '''reusable connection'''
                 self._pool._put_connection(self)
             else:
-                '''no reusable connection, close it and create a new one put to the pool'''
-                self._pool = None
-                try:
-                    self.close()
-                    logger.debug("Close non-reusable connection in pool(%s) caused by %s", self._pool.name, value)
-                except Exception:
-                    self._force_close()
+                '''no reusable connection, close it and remove it from the pool, a new one will be created on demand'''
+                logger.debug("Close non-reusable connection in pool(%s) caused by %s", self._pool.name, value)
+                self._pool._drop_connection(self)
         else:
             pymysql.connections.Connection.__exit__(self, exc, value, traceback)
 
@@ -116,36 +121,69 @@ class Connection(pymysql.connections.Connection):
         :type cursor: :py:class:`Cursor`, :py:class:`SSCursor`, :py:class:`DictCursor`,
             or :py:class:`SSDictCursor`.
         """
-        if cursor:
-            if cursor.__name__ == 'DictCursor':
-                return DictCursor(self)  # custom DictCursor class in this module
-            elif cursor.__name__ == 'Cursor':
-                return Cursor(self)  # custom Cursor class in this module
-            else:
-                # other type dose not has custom db_query() and db_modify() method
-                return cursor(self)
-        else:
-            if self.cursorclass.__name__ == 'DictCursor':
-                return DictCursor(self)
-            elif self.cursorclass.__name__ == 'Cursor':
-                return Cursor(self)
+        if self._returned:
+            # every query starts from a cursor, so this is where a returned connection is refused
+            raise ReturnConnectionToPoolError("this connection has already returned to the pool({})".format(self._pool.name))
+        cursor = cursor or self.cursorclass
+        # pymysql's cursor classes are replaced by the custom ones in this module(an identity lookup, subclasses
+        # are kept as they are), other type dose not has db_query() and db_modify() method unless use_custom_cursor
+        custom = _CUSTOM_CURSORS.get(cursor)
+        if custom is None:
+            if self._use_custom_cursor and not issubclass(cursor, Cursor):
+                return _wrap_cursor(cursor)(self)
+            return cursor(self)
+        return custom(self)
+
+    def execute_query(self, query, args=(), dictcursor=False, return_one=False, exec_many=False):
+        """
+        The execute_query() method of the old versions, kept for backward compatibility;
+        a cursor is created and closed for each call, prefer cursor().db_query()/db_modify() instead.
+
+        dictcursor: whether use DictCursor
+        return_one: only return the first row(None if there is no row), otherwise all the rows
+        exec_many: whether use executemany() method
+        """
+        with self.cursor(pymysql.cursors.DictCursor) if dictcursor else self.cursor() as cur:
+            if isinstance(cur, Cursor):
+                cur._execute(query, args, exec_many)
+            elif exec_many:  # a user defined cursorclass, without the methods of the custom Cursor
+                cur.executemany(query, args)
             else:
-                return self.cursorclass(self)
+                cur.execute(query, args)
+            return cur.fetchone() if return_one else cur.fetchall()
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """
+        Run the statements of the with block in an explicit transaction: commit on success, rollback on exception.
+        Handy with autocommit=True connections, whose single statements need no BEGIN/COMMIT round trips.
+
+            with conn.transaction():
+                cur.db_modify(...)
+        """
+        self.begin()
+        try:
+            yield self
+        except BaseException:
+            self.rollback()
+            raise
+        self.commit()
 
 
 class Cursor(pymysql.cursors.Cursor):
-    def db_query(self, query, args=()):
+    def db_query(self, query, args=(), return_one=False, as_columns=False):
         """
         A wrapped method of Cursor.fetchone() or Cursor.fetchall() when doing select query.
-        The outer layer of return data is always list(always use cursor.fetchall()), to display data with a unified structure.
+        Unless return_one, the outer layer of return data is always list(use cursor.fetchall()), to display data with a unified structure.
+
+        return_one: only return the first row (use cursor.fetchone(), None if there is no row)
+        as_columns: return the result column by column: {column_name: [values]}, handy for bulk analytic reads
+            (e.g. feed a column to numpy.asarray() directly instead of re-assembling it from the rows)
         """
-        # with self:
-        try:
-            # cur = self.cursor(cursorclass) if cursorclass else self.cursor()
-            self.execute(query, args)
-            return self.fetchall()
-        except Exception:
-            raise
+        self._execute(query, args)
+        if as_columns:
+            return self._fetch_columns()
+        return self.fetchone() if return_one else self.fetchall()
 
     def db_modify(self, query, args=(), exec_many=False):
         """
@@ -153,17 +191,59 @@ class Cursor(pymysql.cursors.Cursor):
         return: {'rowcount': xxx, 'lastrowid': xxx}
 
         exec_many: whether use executemany() method
+            for 'INSERT/REPLACE ... VALUES (...)' pymysql already folds all rows of args into multi-row statements
+            (one round trip per max_stmt_length bytes); any other statement costs one round trip per row.
+            args may be any iterable, e.g. a generator: rows are consumed lazily batch by batch,
+            so the whole data set does not have to be materialized as a list first
         """
-        # with self:
-        try:
-            # cur = self.cursor()
-            if not exec_many:
-                rt = self.execute(query, args)
-            else:
-                rt = self.executemany(query, args)
-            return {'rowcount': self.rowcount, 'lastrowid': self.lastrowid}
-        except Exception:
-            raise
+        self._execute(query, args, exec_many)
+        return {'rowcount': self.rowcount, 'lastrowid': self.lastrowid}
+
+    def _fetch_columns(self):
+        """fetch all the rows and transpose them into {column_name: [values]}"""
+        rows = self.fetchall()
+        if not rows:
+            return {d[0]: [] for d in self.description or ()}
+        if isinstance(rows[0], dict):
+            return {name: [row[name] for row in rows] for name in rows[0]}
+        return dict(zip((d[0] for d in self.description), map(list, zip(*rows))))
+
+    def execute(self, query, args=None):
+        """
+        Overwrite the execute() method of pymysql.cursors.Cursor
+        if the connection comes from a pool with raise_mysql_warnings=True, the mysql warnings of the statement are
+        raised as pymysql.err.Warning exception. executemany() runs every row(or INSERT batch) through here
+        """
+        result = super().execute(query, args)
+        if getattr(self.connection, '_raise_warnings', False):
+            self._raise_mysql_warnings()
+        return result
+
+    def _nextset(self, unbuffered=False):
+        """
+        Overwrite the _nextset() method of pymysql.cursors.Cursor(behind nextset())
+        the warnings of a multi result query(e.g. CALL proc()) are checked once its last result set is reached
+        """
+        result = super()._nextset(unbuffered)
+        if result and getattr(self.connection, '_raise_warnings', False):
+            self._raise_mysql_warnings()
+        return result
+
+    def _execute(self, query, args, exec_many=False):
+        """execute() or executemany()"""
+        return self.executemany(query, args) if exec_many else self.execute(query, args)
+
+    def _raise_mysql_warnings(self):
+        """
+        raise the first mysql warning of the last statement as pymysql.err.Warning exception, if there is any.
+        skipped while more result sets are pending: sending SHOW WARNINGS would make pymysql discard them, and it
+        would report on the last statement anyway; _nextset() checks again once the last result set is reached
+        """
+        if self._result is not None and self._result.warning_count and not self._result.has_next:
+            # only ask the server for the warnings when there are some, no extra round trip otherwise
+            mysql_warnings = self.connection.show_warnings()
+            if mysql_warnings:
+                raise pymysql.err.Warning(*mysql_warnings[0][1:3])
 
 
 class DictCursor(pymysql.cursors.DictCursorMixin, Cursor):
@@ -173,6 +253,63 @@ class DictCursor(pymysql.cursors.DictCursorMixin, Cursor):
     """
 
 
+class SSCursor(pymysql.cursors.SSCursor, Cursor):
+    """
+    Unbuffered cursor, rows are read from the server only when they are consumed
+    Inheritance from the custom Cursor class, but db_query() returns an iterator instead of a list,
+    so a large result set is never materialized in memory at once.
+
+    The rows must be consumed (or the cursor closed) before the connection is closed or returned to the pool.
+    """
+    def db_query(self, query, args=(), return_one=False, as_columns=False):
+        """
+        A wrapped method of SSCursor.fetchall_unbuffered() when doing select query, return an iterator of rows.
+
+        return_one: only read and return the first row (None if there is no row)
+        as_columns: read the whole result and return it column by column: {column_name: [values]}
+        """
+        self._execute(query, args)
+        if as_columns:
+            return self._fetch_columns()
+        return self.fetchone() if return_one else self.fetchall_unbuffered()
+
+    def read_next(self):
+        """
+        Overwrite the read_next() method of pymysql.cursors.SSCursor
+        the warning count of an unbuffered result arrives only with its end, so check the warnings once it is read
+        """
+        result = self._result
+        active = result is not None and result.unbuffered_active
+        row = super().read_next()
+        if active and not result.unbuffered_active and getattr(self.connection, '_raise_warnings', False):
+            self._raise_mysql_warnings()
+        return row
+
+
+class SSDictCursor(pymysql.cursors.DictCursorMixin, SSCursor):
+    """
+    An unbuffered cursor which returns results as a dictionary
+    Inheritance from the custom SSCursor class
+    """
+
+
+_CUSTOM_CURSORS = {
+    pymysql.cursors.Cursor: Cursor,
+    pymysql.cursors.DictCursor: DictCursor,
+    pymysql.cursors.SSCursor: SSCursor,
+    pymysql.cursors.SSDictCursor: SSDictCursor,
+}
+_WRAPPED_CURSORS = {}  # other cursor class: its subclass with db_query() and db_modify(), see use_custom_cursor
+
+
+def _wrap_cursor(cursor):
+    """return a subclass of the given cursor class with db_query() and db_modify() mixed in, created once per class"""
+    wrapped = _WRAPPED_CURSORS.get(cursor)
+    if wrapped is None:
+        wrapped = _WRAPPED_CURSORS.setdefault(cursor, type('Wrapped' + cursor.__name__, (Cursor, cursor), {}))
+    return wrapped
+
+
 class ConnectionPool:
     """
     Return connection_pool object, which has method can get connection from a pool with timeout and retry feature;
@@ -180,7 +317,8 @@ class ConnectionPool:
     different pool of different DB Server or different user
     """
 
-    def __init__(self, size=10, maxsize=100, name=None, pre_create_num=0, con_lifetime=3600, *args, **kwargs):
+    def __init__(self, size=10, maxsize=100, name=None, pre_create_num=0, con_lifetime=3600, *args, ping_interval=0,
+                 raise_mysql_warnings=False, use_custom_cursor=False, **kwargs):
         """
         size: int
             normal size of the pool
@@ -192,39 +330,83 @@ class ConnectionPool:
         pre_create_num: int
             create specified number connections at the init phase; otherwise will create connection when really need.
         con_lifetime: int
-            the max lifetime(seconds) of the connections, if it reach the specified seconds, when return to the pool:
-                1. if connction_number<=size, create a new connection and replace the overlifetime one in the pool;
+            the max lifetime(seconds) of the connections. A background thread checks the idle connections every
+            min(60, con_lifetime/4) seconds, the ones reach the specified seconds are closed and:
+                1. if connction_number<size, a new connection is created to replace the overlifetime one in the pool;
                    resolve the problem of mysql server side close due to 'wait_timeout'
-                2. If connction_number>size, close the connection and remove it from the pool.
+                2. If connction_number>=size, only remove it from the pool.
                    used for pool scalability.
+            a connection reach the lifetime is never borrowed from the pool, it is replaced by a new one.
             in order for the arg to work as expect:
                 you should make sure that 'con_lifetime' is less than mysql's 'wait_timeout' variable.
             0 or negative means do not consider the lifetime
+        ping_interval: int (keyword-only)
+            check the idle connections in a background thread every ping_interval seconds: the ones which had been idle
+            for at least ping_interval seconds are pinged, broken ones are dropped from the pool;
+            keep the pool warm and avoid borrowing connections already closed by the mysql server.
+            0 or negative means no background check
+        raise_mysql_warnings: bool (keyword-only)
+            raise mysql warnings as pymysql.err.Warning exception in the statements of the connections' cursors
+            (db_query()/db_modify()/execute()/executemany()). they are checked after each statement, each row or
+            INSERT batch of executemany(); for the unbuffered SSCursor/SSDictCursor only after the last row is read,
+            for a query with several result sets(e.g. CALL proc()) only once nextset() reaches the last one
+        use_custom_cursor: bool (keyword-only)
+            a cursor class other than the pymysql ones(e.g. a user defined subclass of pymysql.cursors.Cursor)
+            is used as it is by default; True gives it the db_query()/db_modify() methods as well
         args & kwargs:
             same as pymysql.connections.Connection()
         """
         self._size = size
         self.maxsize = maxsize
+        # used as a LIFO stack: append() and pop() on the same end.
+        # no maxlen on purpose: a full bounded deque silently discards a connection on append(), leaving it open and
+        # counted; the connections number is limited by _reserve() instead
         self._pool = deque()
+        # bound methods resolved once for the get/put hot path
+        self._pool_pop = self._pool.pop
+        self._pool_put = self._pool.append
+        # get/put themselves are lock-free deque operations, the lock is only taken when waiting on an empty pool
+        # and when the connections number changes
+        self._lock = threading.Lock()
+        self._waiters = deque()  # FIFO of [event, connection] for threads waiting on an empty pool
         self._pre_create_num = pre_create_num if pre_create_num <= maxsize else maxsize
         self._con_lifetime = con_lifetime
-        self._args = args
-        self._kwargs = kwargs
-        self.name = name if name else '-'.join(
-            [kwargs.get('host', 'localhost'), str(kwargs.get('port', 3306)),
-             kwargs.get('user', ''), kwargs.get('database', '')])
-        self._created_num = deque()  # record the number of all used and available connections(use deque for thread-safe)
-
-        if pre_create_num > 0:
-            for _ in range(self._pre_create_num):
-                conn = self._create_connection()
-                self._pool.appendleft(conn)
-                conn._returned = True
-        else:
-            self._args = args
-            self._kwargs = kwargs
+        self._ping_interval = ping_interval
+        self._raise_warnings = raise_mysql_warnings
+        self._use_custom_cursor = use_custom_cursor
+        # bind the connect arguments once, a new connection is then just a call without re-packing args & kwargs
+        self._connection_factory = functools.partial(Connection, *args, **kwargs)
+        self.name = name or "{}-{}-{}-{}".format(kwargs.get('host', 'localhost'), kwargs.get('port', 3306),
+                                                 kwargs.get('user', ''), kwargs.get('database', ''))
+        self._created_num = 0  # number of all used and available connections, only changed under self._lock
+        # the lifetime and idle checks run in a background thread, started along with the first connection
+        intervals = [i for i in (ping_interval, min(60, con_lifetime / 4)) if i > 0]
+        self._maintain_interval = min(intervals) if intervals else 0
+        self._maintainer = None
+        self._closed = threading.Event()  # set by close(), stops the background thread
+        # also stop it as soon as the pool is garbage collected, the thread holds only a weak reference to the pool
+        weakref.finalize(self, self._closed.set)
+
+        if self._pre_create_num > 0:
+            # establish the connections concurrently, so the handshakes overlap instead of running one after another
+            error = None
+            with ThreadPoolExecutor(max_workers=min(self._pre_create_num, 32)) as executor:
+                futures = [executor.submit(lambda: self._reserve() and self._create_connection())
+                           for _ in range(self._pre_create_num)]
+                for future in as_completed(futures):  # put into the pool as soon as each one is established
+                    try:
+                        conn = future.result()
+                    except Exception as e:
+                        error = error or e
+                        continue
+                    conn._returned = True
+                    self._pool_put(conn)
+            if error is not None:
+                # don't leave the established connections open behind a pool which failed to init
+                self.close()
+                raise error
 
-    def get_connection(self, retry_num=3, retry_interval=0.1, pre_ping=False):
+    def get_connection(self, retry_num=3, retry_interval=0.1, pre_ping=False, backoff=1, jitter=0, max_interval=10):
         """
         retry_num: int
             how many times will retry to get a connection
@@ -232,79 +414,245 @@ class ConnectionPool:
             timeout of get a connection from pool(0 means return or raise immediately)
         pre_ping: bool
             before return a connection, send a ping command to the Mysql server, if the connection is broken, reconnect it
+        backoff: float
+            multiply retry_interval by backoff after each retry, e.g. 2 for exponential backoff; 1 means fixed interval
+        max_interval: float
+            upper bound(seconds) of the retry interval grown by backoff
+        jitter: float
+            randomize each retry interval within +/- jitter of it(e.g. 0.2 for 20%), so that the threads started
+            waiting together don't all give up and hit the maxsize limit at the same time; 0 means no jitter
         """
-        if retry_num > 10:
-            retry_num = 10  # retry_num hard limit
-        try:
-            conn = self._pool.pop()
-        except IndexError:
-            if self.total_num < self._size:
-                return self._create_connection()
-            if retry_num > 0:
-                retry_num -= 1
-                time.sleep(retry_interval)
-                logger.debug('Retry to get connection from pool(%s)', self.name)
-                return self.get_connection(retry_num, retry_interval, pre_ping)
-            else:
-                if self.total_num < self.maxsize:
+        retry_num = min(retry_num, 10)  # retry_num hard limit
+        while True:
+            try:
+                conn = self._pool_pop()
+                break
+            except IndexError:
+                if self._reserve(self._size):
                     return self._create_connection()
-                else:
-                    raise GetConnectionFromPoolError("can't get connection from pool({}), due to pool lack.".format(self.name))
+                if retry_num > 0:
+                    retry_num -= 1
+                    conn = self._wait_connection(random.uniform(retry_interval * (1 - jitter),
+                                                                retry_interval * (1 + jitter))
+                                                 if jitter else retry_interval)
+                    if conn is not None:
+                        break
+                    if backoff != 1:
+                        retry_interval = min(retry_interval * backoff, max_interval)
+                    logger.debug('Retry to get connection from pool(%s)', self.name)
+                    continue
+                if self._reserve(self.maxsize):
+                    return self._create_connection()
+                raise GetConnectionFromPoolError("can't get connection from pool({}), due to pool lack.".format(self.name))
 
         # check con_lifetime
         conn._returned = False
-        if self._con_lifetime > 0 and int(time.time()) - conn._create_ts >= self._con_lifetime:
-            conn._pool = None
-            try:
-                conn.close()
-            except:
-                conn._force_close()
-            self._created_num.pop()
+        lifetime = self._con_lifetime  # read once, it's compared twice on every checkout
+        if lifetime > 0 and time.monotonic() - conn._create_ts >= lifetime:
+            # loss one, create one: the replacement takes over the slot, so no other thread can take it in between
+            self._drop_connection(conn, uncount=False)
             logger.debug("Close connection in pool(%s) due to lifetime reached", self.name)
-            # loss one, create one
             return self._create_connection()
         else:
             if pre_ping:
                 conn.ping(reconnect=True)
 
-        logger.debug('Get connection from pool(%s)', self.name)
+        if logger.isEnabledFor(logging.DEBUG):  # hot path, skip the call and args packing when debug is off
+            logger.debug('Get connection from pool(%s)', self.name)
         return conn
 
     def _put_connection(self, conn):
-        if not hasattr(conn, '_pool') or conn._pool is None:
+        if conn._pool is None:  # _pool is a class attribute of Connection, always present
             return
-        conn.cursor().close()
         if not conn._returned:
-            # consider the connection lifetime with the purpose of reduce active connections number
-            if self._con_lifetime > 0 and int(time.time()) - conn._create_ts >= self._con_lifetime:
-                conn._pool = None
-                try:
-                    conn.close()
-                except:
-                    conn._force_close()
-                self._created_num.pop()
-                logger.debug("Close connection in pool(%s) due to lifetime reached", self.name)
-                if self.total_num >= self._size:
-                    conn._returned = True
-                    return
-                conn = self._create_connection()
+            # the connection lifetime is considered by the background thread, keep the return path short
             conn._returned = True
-            self._pool.appendleft(conn)
-            logger.debug("Put connection back to pool(%s)", self.name)
+            if self._ping_interval > 0:  # the idle time is only looked at by the background ping
+                conn._last_used_ts = time.monotonic()
+            # LIFO(like SQLAlchemy's pool_use_lifo=True): the most recently used connection is handed out first,
+            # its socket and server side session are still warm, the idle ones age out at the other end
+            self._pool_put(conn)
+            if self._waiters:
+                self._hand_off()
+            if logger.isEnabledFor(logging.DEBUG):
+                logger.debug("Put connection back to pool(%s)", self.name)
         else:
             raise ReturnConnectionToPoolError("this connection has already returned to the pool({})".format(self.name))
 
+    def _wait_connection(self, timeout):
+        """wait at most timeout seconds for a connection put back to the pool, return None if timed out"""
+        waiter = [threading.Event(), None]
+        with self._lock:
+            # register before checking the pool, so a concurrent put can't miss to hand off to us
+            self._waiters.append(waiter)
+            try:
+                conn = self._pool.pop()
+            except IndexError:
+                pass
+            else:
+                self._waiters.pop()
+                return conn
+        waiter[0].wait(timeout)
+        with self._lock:
+            if waiter[1] is None:
+                self._waiters.remove(waiter)
+        return waiter[1]
+
+    def _hand_off(self):
+        """hand the connections in the pool directly to the waiting threads, the longest waiting one first"""
+        with self._lock:
+            while self._waiters:
+                try:
+                    conn = self._pool.pop()
+                except IndexError:
+                    return
+                waiter = self._waiters.popleft()
+                waiter[1] = conn
+                waiter[0].set()
+
+    def _reserve(self, limit=None):
+        """
+        count in a connection about to be created, unless the connections number has reached limit(None means no limit).
+        check and increment are done in one go under the lock, so that concurrent callers can't overshoot the limit
+        """
+        with self._lock:
+            if limit is not None and self._created_num >= limit:
+                return False
+            self._created_num += 1
+            if self._maintainer is None and self._maintain_interval > 0 and not self._closed.is_set():
+                self._maintainer = threading.Thread(target=self._maintain, name='pymysqlpool-{}'.format(self.name),
+                                                    args=(weakref.ref(self), self._maintain_interval, self._closed),
+                                                    daemon=True)
+                self._maintainer.start()
+        return True
+
     def _create_connection(self):
-        conn = Connection(*self._args, **self._kwargs)
+        """create a connection counted in by _reserve() already, count it out again if the connect fails"""
+        try:
+            conn = self._connection_factory()
+        except Exception:
+            with self._lock:
+                self._created_num -= 1
+            raise
         conn._pool = self
-        # add attr create timestamp for connection
-        conn._create_ts = int(time.time())
+        # add attr create timestamp for connection(monotonic clock, not affected by system time changes)
+        conn._create_ts = time.monotonic()
         # add attr indicate whether the connection has already return to pool, should not use any more
         conn._returned = False
-        self._created_num.append(1)
+        conn._last_used_ts = conn._create_ts
+        conn._raise_warnings = self._raise_warnings
+        conn._use_custom_cursor = self._use_custom_cursor
         logger.debug('Create new connection in pool(%s)', self.name)
         return conn
 
+    def _drop_connection(self, conn, uncount=True):
+        """
+        close a connection for good and remove it from the connections number;
+        uncount=False keeps it counted, for the caller to create a replacement in the same slot
+        """
+        conn._pool = None
+        try:
+            conn.close()
+        except Exception:
+            conn._force_close()
+        if uncount:
+            with self._lock:
+                if self._created_num > 0:
+                    self._created_num -= 1
+
+    @staticmethod
+    def _maintain(pool_ref, interval, closed):
+        """
+        background loop: retire the connections reach the lifetime, ping the idle ones.
+        the pool is only weakly referenced between the rounds, so an unused pool can still be garbage collected
+        """
+        while not closed.wait(interval):
+            pool = pool_ref()
+            if pool is None:
+                return
+            if pool._con_lifetime > 0:
+                pool._retire_expired()
+            if pool._ping_interval > 0:
+                pool._ping_idle()
+            del pool
+
+    def _retire_expired(self):
+        """close the idle connections reach the lifetime, replace them while connections number is less than size"""
+        now = time.monotonic()
+        for conn in list(self._pool):
+            if now - conn._create_ts < self._con_lifetime:
+                continue
+            try:
+                self._pool.remove(conn)
+            except ValueError:
+                continue  # borrowed in the meantime
+            self._drop_connection(conn)
+            logger.debug("Close connection in pool(%s) due to lifetime reached", self.name)
+            if self._closed.is_set():
+                return  # close() is draining the pool, don't open a new connection behind it
+            if self._reserve(self._size):
+                try:
+                    conn = self._create_connection()
+                except Exception as e:
+                    # not fatal, get_connection() will create it on demand
+                    logger.warning("Can't replace overlifetime connection in pool(%s): %s", self.name, e)
+                    continue
+                conn._returned = True
+                self._pool_put(conn)
+                if self._waiters:
+                    self._hand_off()
+
+    def _ping_idle(self):
+        """ping the connections idle for at least ping_interval seconds, drop the broken ones"""
+        now = time.monotonic()
+        for conn in list(self._pool):
+            if now - conn._last_used_ts < self._ping_interval:
+                continue
+            try:
+                # take it out of the pool while pinging, so that no one can borrow it meanwhile
+                self._pool.remove(conn)
+            except ValueError:
+                continue  # borrowed in the meantime
+            try:
+                conn.ping(reconnect=False)
+            except Exception:
+                self._drop_connection(conn)
+                logger.debug("Drop broken idle connection in pool(%s)", self.name)
+            else:
+                if self._closed.is_set():
+                    self._drop_connection(conn)
+                    return
+                conn._last_used_ts = time.monotonic()
+                self._pool.appendleft(conn)  # still idle, put it back to the cold end of the pool
+                if self._waiters:
+                    self._hand_off()
+
+    def close(self):
+        """
+        stop the background thread and close all the available connections in the pool.
+        the pool can't be used any more: get_connection() raises GetConnectionFromPoolError,
+        the connections in use are closed(instead of pooled) when they are returned
+        """
+        self._closed.set()
+        # rebind the hot path methods rather than checking a flag on every get/put
+        self._pool_pop = self._refuse_connection
+        self._pool_put = self._drop_connection
+        with self._lock:
+            maintainer = self._maintainer  # no new one can be started once _closed is set
+        if maintainer is not None and maintainer is not threading.current_thread():
+            maintainer.join()  # let a running round finish, it may still hold a connection out of the pool
+        while True:
+            try:
+                conn = self._pool.pop()
+            except IndexError:
+                break
+            self._drop_connection(conn)
+        logger.debug("Close pool(%s)", self.name)
+
+    def _refuse_connection(self):
+        """stand in for the pool pop of a closed pool"""
+        raise GetConnectionFromPoolError("can't get connection from pool({}), the pool has been closed.".format(self.name))
+
     @property
     def available_num(self):
         """available connections number for now"""
@@ -313,7 +661,35 @@ class ConnectionPool:
     @property
     def total_num(self):
         """total connections number of all used and available"""
-        return len(self._created_num)
+        return self._created_num
+
+    @property
+    def size(self):
+        """alias of available_num, the name used by the old versions"""
+        return self.available_num
+
+    @property
+    def connection_num(self):
+        """alias of total_num, the name used by the old versions"""
+        return self.total_num
+
+
+def _freeze(value):
+    """
+    normalize a pool config value into a hashable one for the ConnectionPoolSingleton key: dicts(e.g. the ssl dict)
+    don't depend on their order, other objects are compared by value if hashable, or by repr() as the last resort
+    """
+    if isinstance(value, dict):
+        return tuple(sorted(((k, _freeze(v)) for k, v in value.items()), key=lambda item: repr(item[0])))
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__, tuple(_freeze(v) for v in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(_freeze(v) for v in value)
+    try:
+        hash(value)
+    except TypeError:
+        return repr(value)
+    return value
 
 
 class GetConnectionFromPoolError(Exception):
@@ -324,24 +700,50 @@ class ReturnConnectionToPoolError(Exception):
     """Exception related can't return connection to pool."""
 
 
-def already_returned_conn(f):
-    @functools.wraps(f)
-    def wrapper(*args, **kwargs):
-        # args[0] means self(connection object)
-        if hasattr(args[0], '_returned') and args[0]._returned:
-            raise ReturnConnectionToPoolError("this connection has already returned to the pool({})".format(args[0]._pool.name))
-        return f(*args, **kwargs)
-    return wrapper
-
+class ConnectionPoolSingleton(ConnectionPool):
+    """
+    Same as ConnectionPool, but there is only one pool per distinct pool config(arguments):
+    instantiating it again with the same config returns the existing pool instead of opening another one,
+    so that several pools don't compete for mysql's 'max_connections'
+    """
+    _instances = {}
+    _instances_lock = threading.Lock()  # only guards _instances, a pool is initialized outside of it
 
-for name, fn in inspect.getmembers(Connection, inspect.isfunction):
-    if not name.startswith('_'):
-        setattr(Connection, name, already_returned_conn(fn))
+    def __new__(cls, *args, **kwargs):
+        key = (cls, _freeze(args), _freeze(kwargs))
+        while True:
+            with cls._instances_lock:
+                pool = cls._instances.get(key)
+                if pool is None:
+                    # reserve the key, then initialize outside the lock, so that a slow pool(e.g. pre-create
+                    # handshakes) doesn't block the other configs. python calls __init__() again on every
+                    # instantiation, so it is done here only once
+                    pool = cls._instances[key] = ConnectionPool.__new__(cls)
+                    pool._instance_key = key
+                    pool._initialized = threading.Event()
+                    break
+            pool._initialized.wait()  # the same config being initialized by another thread
+            if not getattr(pool, '_init_failed', False):
+                return pool
+            # that one failed and has been forgotten, try it ourselves
+        try:
+            ConnectionPool.__init__(pool, *args, **kwargs)
+        except BaseException:
+            pool._init_failed = True
+            with cls._instances_lock:
+                if cls._instances.get(key) is pool:
+                    del cls._instances[key]
+            raise
+        finally:
+            pool._initialized.set()
+        return pool
 
+    def __init__(self, *args, **kwargs):
+        """the pool has been initialized by __new__(), don't reset it"""
 
-class ConnectionPoolSingleton(ConnectionPool):
-    _instance = None
-    def __new__(cls, *args, **kwargs):
-        if cls._instance is None:
-            cls._instance = ConnectionPool.__new__(cls)
-        return cls._instance
+    def close(self):
+        """same as ConnectionPool.close(), and forget the pool: instantiating again with the config opens a new one"""
+        with self._instances_lock:
+            if self._instances.get(self._instance_key) is self:
+                del self._instances[self._instance_key]
+        ConnectionPool.close(self)